@@ -0,0 +1,40 @@
+import os
+import sqlite3
+import threading
+
+# === On-disk key/value store for LLM responses ===
+CACHE_PATH = os.path.join(os.path.dirname(__file__), "../output", ".llm_cache.sqlite")
+
+_lock = threading.Lock()
+_conn = None
+
+def _connect():
+    """Open the cache database once and share it across worker threads."""
+    global _conn
+    if _conn is None:
+        os.makedirs(os.path.dirname(CACHE_PATH), exist_ok=True)
+        _conn = sqlite3.connect(CACHE_PATH, check_same_thread=False)
+        _conn.execute("PRAGMA journal_mode=WAL")
+        _conn.execute("CREATE TABLE IF NOT EXISTS kv(k TEXT PRIMARY KEY, v TEXT)")
+        _conn.commit()
+    return _conn
+
+def get(key):
+    """Return the cached value for key, or None on a miss."""
+    with _lock:
+        row = _connect().execute("SELECT v FROM kv WHERE k = ?", (key,)).fetchone()
+    return row[0] if row else None
+
+def put(key, value):
+    """Store value under key, replacing any previous entry."""
+    with _lock:
+        conn = _connect()
+        conn.execute("INSERT OR REPLACE INTO kv(k, v) VALUES (?, ?)", (key, value))
+        conn.commit()
+
+def delete(key):
+    """Drop key from the cache, e.g. when its stored value turned out to be unusable."""
+    with _lock:
+        conn = _connect()
+        conn.execute("DELETE FROM kv WHERE k = ?", (key,))
+        conn.commit()
@@ -1,74 +1,250 @@
 import os
 import sys
+import asyncio
 import re
+import json
+import itertools
+import hashlib
+import subprocess
+import threading
+import time
+import httpx
+import orjson
 import requests
-import pypandoc
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from aiolimiter import AsyncLimiter
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
+from concurrent.futures import ThreadPoolExecutor
+import cache
 
 # === Load environment variables ===
 load_dotenv()
 API_KEY = os.getenv("OPENROUTER_API_KEY")
+_URL = "https://openrouter.ai/api/v1/chat/completions"
+_HEADERS = {
+    "Authorization": f"Bearer {API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "http://localhost",
+    "X-Title": "Code Tool"
+}
 MODEL = "qwen/qwen-2.5-72b-instruct"
+PROMPT_VERSION = "1"  # bump when the system prompt changes to invalidate cached responses
 
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "../output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, ".manifest.json")
+MANIFEST_VERSION = f"{MODEL}:{PROMPT_VERSION}"  # stored explanations are only reused under the same model + prompts
 
 ALLOWED_EXTENSIONS = {".py", ".js", ".html", ".css", ".ts", ".jsx", ".java", ".cpp"}
 EXCLUDE_DIRS = {"node_modules", ".git", "dist", "build", "__pycache__"}
+MAX_CONCURRENCY = 32  # in-flight explanation requests
+REQUESTS_PER_MINUTE = int(os.getenv("OPENROUTER_RPM", "60"))
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+MAX_BATCH_FILES = 8  # files summarized per request
+MAX_BATCH_CHARS = 6000  # code characters per request
+PROJECT_CODE_CHARS = 12000  # code sent with explain_project prompts
+
+# Oversized files are summarized from their head and tail only, which keeps
+# each request bounded while still covering every file.
+HEAD_CHARS = 4000
+TAIL_CHARS = 1000
+MAX_INPUT_CHARS = HEAD_CHARS + TAIL_CHARS
+
+# Hard cap on a single file's body in the code PDF: minified bundles and generated
+# files can exhaust xelatex's memory and fail the whole document. The PDF head
+# and tail cover the model's, so explanations are unaffected.
+PDF_HEAD_CHARS = 40_000
+PDF_TAIL_CHARS = 10_000
+MAX_PDF_CHARS = PDF_HEAD_CHARS + PDF_TAIL_CHARS
+
+# === Shared HTTP session so blocking calls reuse keep-alive connections ===
+# No urllib3-level retries: a chat-completion POST isn't idempotent, so retrying
+# is left to the one tenacity policy shared by the sync and async paths.
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=16, pool_maxsize=16))
+
+# === Requests are paced to the OpenRouter rate limit: async calls share one token
+# bucket, blocking calls are spaced out under a lock ===
+_LIMITER = AsyncLimiter(REQUESTS_PER_MINUTE, time_period=60)
+_SYNC_LIMIT_LOCK = threading.Lock()
+_next_sync_slot = 0.0
+
+_SAFE_PATH_RE = re.compile(r"([_#{}$%&~^\\])")
+# Tolerates stray markdown emphasis and spacing around "===FILE k===" markers
+_FILE_MARKER_RE = re.compile(r"[*_]*[ \t]*===[ \t]*FILE[ \t]+(\d+)[ \t]*===[ \t]*[*_]*")
 
 def safe_path(path: str) -> str:
     """Make file paths safe for Markdown/PDF conversion."""
     path = path.replace("\\", "/")
-    specials = r"([_#{}$%&~^\\])"
-    return re.sub(specials, r"\\\1", path)
+    return _SAFE_PATH_RE.sub(r"\\\1", path)
 
 def read_code(file_path):
     with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
         return f.read()
 
+def truncate_code(code, head=HEAD_CHARS, tail=TAIL_CHARS):
+    """Trim code longer than head + tail characters to its head and tail (defaults: the model budget)."""
+    if len(code) <= head + tail:
+        return code
+    return code[:head] + "\n...[truncated]...\n" + code[-tail:]
+
 def remove_non_ascii(text):
     """Remove all non-ASCII characters to prevent LaTeX errors."""
     return text.encode('ascii', errors='ignore').decode('ascii')
 
-def save_pdf_from_markdown(markdown_text, output_path):
-    """Convert markdown text to PDF using xelatex for Unicode support."""
-    pypandoc.convert_text(
-        markdown_text,
-        'pdf',
-        format='md',
-        outputfile=output_path,
-        extra_args=['--pdf-engine=xelatex', '--standalone']
-    )
+def save_pdf_from_markdown(markdown, output_path, from_format="markdown"):
+    """Convert markdown to PDF using xelatex for Unicode support.
 
-def call_llm(prompt):
-    """Generic function to send a prompt to Qwen via OpenRouter."""
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {API_KEY}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "http://localhost",
-        "X-Title": "Code Tool"
-    }
-    payload = {
+    markdown may be a string or an iterable of string chunks; chunks are
+    streamed into pandoc's stdin so the full document is never joined in memory.
+    from_format is pandoc's input format, e.g. to switch off markdown extensions.
+    Calls pandoc directly: pypandoc.convert_text spawns pandoc extra times
+    just to probe its supported formats.
+    """
+    chunks = [markdown] if isinstance(markdown, str) else markdown
+    cmd = ["pandoc", "-f", from_format, "-t", "pdf", "--pdf-engine=xelatex", "--standalone", "-o", output_path]
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL)
+    try:
+        for chunk in chunks:
+            proc.stdin.write(chunk.encode("utf-8"))
+    except BrokenPipeError:
+        pass  # pandoc exited early; its return code below reports the failure
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+    if proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+def _cache_key(prompt):
+    return hashlib.sha256((MODEL + PROMPT_VERSION + prompt).encode()).hexdigest()
+
+def _build_payload(prompt):
+    return {
         "model": MODEL,
         "messages": [
             {"role": "system", "content": "You are a helpful programming tutor."},
             {"role": "user", "content": prompt}
         ]
     }
-    resp = requests.post(url, headers=headers, json=payload)
+
+def _response_content(resp):
+    """Pull the reply text out of a chat completion response, parsed with orjson."""
+    return remove_non_ascii(orjson.loads(resp.content)["choices"][0]["message"]["content"])
+
+def _is_retryable(exc):
+    if isinstance(exc, httpx.HTTPStatusError):
+        return exc.response.status_code in RETRY_STATUSES
+    if isinstance(exc, requests.HTTPError):
+        return exc.response is not None and exc.response.status_code in RETRY_STATUSES
+    return isinstance(exc, (httpx.TransportError, requests.ConnectionError, requests.Timeout))
+
+def _log_retry(retry_state):
+    print(f"🔁 Retrying request (attempt {retry_state.attempt_number}): {retry_state.outcome.exception()}")
+
+# The only retry layer for OpenRouter requests (the session adapter has none), so each
+# attempt goes through the rate limiter and a failing call sends at most 5 POSTs
+_retry_policy = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_exponential(min=1, max=30),
+    stop=stop_after_attempt(5),
+    before_sleep=_log_retry,
+    reraise=True
+)
+
+def _wait_for_sync_slot():
+    """Space blocking requests at least 60 / REQUESTS_PER_MINUTE seconds apart."""
+    global _next_sync_slot
+    with _SYNC_LIMIT_LOCK:
+        now = time.monotonic()
+        delay = _next_sync_slot - now
+        _next_sync_slot = max(now, _next_sync_slot) + 60 / REQUESTS_PER_MINUTE
+    if delay > 0:
+        time.sleep(delay)
+
+@_retry_policy
+def _post(payload):
+    """Blocking POST under the sync rate limit; every attempt, retries included, waits for a slot."""
+    _wait_for_sync_slot()
+    resp = _SESSION.post(_URL, headers=_HEADERS, json=payload, timeout=(5, 60))
     resp.raise_for_status()
-    return remove_non_ascii(resp.json()["choices"][0]["message"]["content"])
+    return resp
+
+def call_llm(prompt):
+    """Generic function to send a prompt to Qwen via OpenRouter.
 
-def get_explanation(code):
+    Responses are cached on disk, so an identical prompt is only sent once.
+    """
+    key = _cache_key(prompt)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    resp = _post(_build_payload(prompt))
+    content = _response_content(resp)
+    cache.put(key, content)
+    return content
+
+@_retry_policy
+async def _post_async(client, payload):
+    """POST under the shared rate limiter, retrying rate-limit and server errors with backoff."""
+    async with _LIMITER:
+        resp = await client.post(_URL, headers=_HEADERS, json=payload)
+    resp.raise_for_status()
+    return resp
+
+async def call_llm_async(client, prompt):
+    """Async counterpart of call_llm that posts through a shared httpx.AsyncClient."""
+    key = _cache_key(prompt)
+    cached = cache.get(key)
+    if cached is not None:
+        return cached
+
+    resp = await _post_async(client, _build_payload(prompt))
+    content = _response_content(resp)
+    cache.put(key, content)
+    return content
+
+async def get_explanation(client, code):
     """Get short explanation for given code."""
     prompt = (
         "Summarize the given code in at most TWO short sentences. "
         "Avoid detailed breakdowns — just say what it does.\n\n"
-        f"```{code}```"
+        f"```{truncate_code(code)}```"
     )
-    return call_llm(prompt)
+    return await call_llm_async(client, prompt)
+
+async def get_explanations_batch(client, batch):
+    """Explain several files with one request.
+
+    batch is a list of (ext, code) pairs; returns one explanation per entry,
+    in order. If the reply doesn't contain exactly one marker per file, every
+    file is explained on its own instead.
+    """
+    if len(batch) == 1:
+        return [await get_explanation(client, batch[0][1])]
+
+    prompt = (
+        "Summarize each of the following files in at most TWO short sentences. "
+        "Avoid detailed breakdowns — just say what it does. "
+        "For every file, emit '===FILE k===' on its own line (k is the file number) followed by its summary.\n\n"
+        + "\n".join(f"===FILE {i}===\n```{ext[1:]}\n{truncate_code(code)}```" for i, (ext, code) in enumerate(batch))
+    )
+    text = await call_llm_async(client, prompt)
+
+    parts = _FILE_MARKER_RE.split(text)
+    ids = [int(k) for k in parts[1::2]]
+    summaries = [v.strip() for v in parts[2::2]]
+    if ids == list(range(len(batch))) and all(summaries):
+        return summaries
+
+    # The reply drifted from the requested format (missing, renumbered or repeated
+    # markers); don't reuse it on later runs and explain each file on its own
+    print(f"⚠️ Could not parse batched explanation for {len(batch)} files, retrying individually...")
+    cache.delete(_cache_key(prompt))
+    return list(await asyncio.gather(*(get_explanation(client, code) for _, code in batch)))
 
 def generate_quiz(all_explanations):
     """Generate 10 MCQs for the entire project."""
@@ -82,97 +258,209 @@ def generate_quiz(all_explanations):
     )
     return call_llm(prompt)
 
-def process_file(file_path, rel_path, counter):
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext not in ALLOWED_EXTENSIONS:
-        return None, None
-
-    if os.path.getsize(file_path) > 50_000:
-        print(f"⏩ Skipping large file: {rel_path}")
-        return None, None
+def _walk(folder, extensions=ALLOWED_EXTENSIONS, exclude_dirs=EXCLUDE_DIRS):
+    """Yield (entry, ext) for matching files under folder, in sorted top-down order.
 
+    os.scandir hands back the directory entry with its type, so files need no
+    separate stat and each extension is computed once.
+    """
+    try:
+        with os.scandir(folder) as it:
+            entries = sorted(it, key=lambda e: e.name)
+    except OSError as e:
+        # Like os.walk, skip directories that can't be listed (permissions, removed mid-walk)
+        print(f"⚠️ Skipping {folder}: {e}")
+        return
+    subdirs = []
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            if entry.name not in exclude_dirs:
+                subdirs.append(entry.path)
+        elif entry.is_file():
+            ext = os.path.splitext(entry.name)[1].lower()
+            if ext in extensions:
+                yield entry, ext
+    for subdir in subdirs:
+        yield from _walk(subdir, extensions, exclude_dirs)
+
+def process_file(file_path, rel_path):
+    """Read a source file for the PDFs, capping very large ones."""
     code = read_code(file_path)
-    safe_rel = safe_path(rel_path)
+    if len(code) > MAX_PDF_CHARS:
+        print(f"✂️ Showing only the start and end of very large file: {rel_path}")
+        code = truncate_code(code, PDF_HEAD_CHARS, PDF_TAIL_CHARS)
+    elif len(code) > MAX_INPUT_CHARS:
+        print(f"✂️ Explaining only the start and end of large file: {rel_path}")
+
+    return code
+
+def make_batches(files):
+    """Group (rel_path, ext, code) entries into batches bounded by size and count."""
+    batches, batch, size = [], [], 0
+    for entry in files:
+        length = min(len(entry[2]), MAX_INPUT_CHARS)
+        if batch and (size + length > MAX_BATCH_CHARS or len(batch) >= MAX_BATCH_FILES):
+            batches.append(batch)
+            batch, size = [], 0
+        batch.append(entry)
+        size += length
+    if batch:
+        batches.append(batch)
+    return batches
+
+async def explain_batch(client, sem, batch):
+    async with sem:
+        for rel_path, _, _ in batch:
+            print(f"📤 Explaining {rel_path}...")
+        return await get_explanations_batch(client, [(ext, code) for _, ext, code in batch])
+
+async def explain_files(files):
+    """Explain every (rel_path, ext, code) entry, batching several files per request."""
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    limits = httpx.Limits(max_connections=64)
+    timeout = httpx.Timeout(60, connect=5)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout) as client:
+        tasks = [asyncio.create_task(explain_batch(client, sem, batch)) for batch in make_batches(files)]
+        results = await asyncio.gather(*tasks)
+    return [explanation for batch in results for explanation in batch]
+
+def _read_manifest():
+    try:
+        with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def load_manifest(folder_path):
+    """Return the {rel_path: {"sha", "explanation"}} map saved by the previous run on folder_path.
+
+    The manifest holds one section per absolute folder path, stamped with the
+    model and prompt version; a section written under a different one is ignored.
+    """
+    section = _read_manifest().get(os.path.abspath(folder_path))
+    if not isinstance(section, dict) or section.get("version") != MANIFEST_VERSION:
+        return {}
+    return section.get("files", {})
+
+def save_manifest(folder_path, files):
+    """Replace folder_path's section of the manifest, keeping every other folder's."""
+    manifest = _read_manifest()
+    manifest[os.path.abspath(folder_path)] = {"version": MANIFEST_VERSION, "files": files}
+    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
 
-    code_md = f"## {counter}. {safe_rel}\n```{ext[1:]}\n{code}\n```\n\n"
-    print(f"📤 Explaining {rel_path}...")
-    explanation = get_explanation(code)
-    explanation_md = f"## {counter}. {safe_rel}\n\n{explanation}\n\n"
+def process_folder(folder_path):
+    explanation_parts = ["# Project Code with Short Explanations\n\n"]
+
+    files = []
+
+    for entry, ext in _walk(folder_path):
+        rel_path = os.path.relpath(entry.path, folder_path)
+        files.append((rel_path, ext, process_file(entry.path, rel_path)))
+
+    # Only files whose content changed since the last run go to the model
+    manifest = load_manifest(folder_path)
+    new_manifest = {}
+    explanations = [None] * len(files)
+    pending = []
+    for i, (rel_path, ext, code) in enumerate(files):
+        sha = hashlib.sha256(code.encode("utf-8")).hexdigest()
+        entry = manifest.get(rel_path, {})
+        if entry.get("sha") == sha and entry.get("explanation"):
+            explanations[i] = entry["explanation"]
+        else:
+            pending.append(i)
+        new_manifest[rel_path] = {"sha": sha}
+
+    if not files:
+        print("⚠️ No matching source files found.")
+    elif pending:
+        fresh = asyncio.run(explain_files([files[i] for i in pending]))
+        for i, explanation in zip(pending, fresh):
+            explanations[i] = explanation
+    else:
+        print("✅ No files changed since the last run.")
+
+    for (rel_path, _, _), explanation in zip(files, explanations):
+        new_manifest[rel_path]["explanation"] = explanation
+    save_manifest(folder_path, new_manifest)
+
+    # Results come back in walk order, so section numbers are identical between runs
+    for num, ((rel_path, _, _), explanation) in enumerate(zip(files, explanations), start=1):
+        explanation_parts.append(f"## {num}. {safe_path(rel_path)}\n\n{explanation}\n\n")
+
+    # The code PDF holds every file's (capped) source, so its sections are generated
+    # lazily while streaming to pandoc rather than kept as a second copy
+    code_parts = itertools.chain(
+        ["# Project Code\n\n"],
+        (f"## {num}. {safe_path(rel_path)}\n```{ext[1:]}\n{code}\n```\n\n"
+         for num, (rel_path, ext, code) in enumerate(files, start=1))
+    )
 
-    return code_md, explanation_md
+    all_explanations_text = "".join(part + "\n" for part in explanation_parts[1:])
 
-def process_folder(folder_path):
-    code_md = "# Project Code\n\n"
-    explanation_md = "# Project Code with Short Explanations\n\n"
-    all_explanations_text = ""
-
-    tasks = []
-    counter = 1
-
-    with ThreadPoolExecutor(max_workers=5) as executor:
-        for root, dirs, files in os.walk(folder_path):
-            dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS]
-            for file in sorted(files):
-                ext = os.path.splitext(file)[1].lower()
-                if ext not in ALLOWED_EXTENSIONS:
-                    continue
-
-                file_path = os.path.join(root, file)
-                rel_path = os.path.relpath(file_path, folder_path)
-                tasks.append(executor.submit(process_file, file_path, rel_path, counter))
-                counter += 1
-
-        for future in as_completed(tasks):
-            file_code_md, file_explanation_md = future.result()
-            if file_code_md and file_explanation_md:
-                code_md += file_code_md
-                explanation_md += file_explanation_md
-                all_explanations_text += file_explanation_md + "\n"
-
-    # Save code + explanation PDFs
-    save_pdf_from_markdown(code_md, os.path.join(OUTPUT_DIR, "code_only11.pdf"))
-    save_pdf_from_markdown(explanation_md, os.path.join(OUTPUT_DIR, "code_with_explanation11.pdf"))
-
-    # Generate quiz
-    print("📝 Generating quiz...")
-    quiz_text = generate_quiz(all_explanations_text)
-    quiz_md = "# Project Quiz\n\n" + quiz_text
-    save_pdf_from_markdown(quiz_md, os.path.join(OUTPUT_DIR, "quiz11.pdf"))
+    # Each pandoc run is an independent subprocess, so render the PDFs in parallel;
+    # the code + explanation PDFs build while the quiz is being generated.
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        pdf_jobs = [
+            executor.submit(save_pdf_from_markdown, code_parts, os.path.join(OUTPUT_DIR, "code_only11.pdf")),
+            executor.submit(save_pdf_from_markdown, explanation_parts, os.path.join(OUTPUT_DIR, "code_with_explanation11.pdf")),
+        ]
+
+        # Generate quiz
+        print("📝 Generating quiz...")
+        quiz_text = generate_quiz(all_explanations_text)
+        quiz_md = "# Project Quiz\n\n" + quiz_text
+        pdf_jobs.append(executor.submit(save_pdf_from_markdown, quiz_md, os.path.join(OUTPUT_DIR, "quiz11.pdf")))
+
+        for job in pdf_jobs:
+            job.result()
 
 # ADD THIS AT THE END OF explainer.py, before `if __name__ == "__main__":`
 
-def explain_project(project_path):
+def collect_files(project_path, extensions=ALLOWED_EXTENSIONS, exclude_dirs=EXCLUDE_DIRS):
+    """Walk project_path once and return {rel_path: code} for matching files."""
+    sources = {}
+    for entry, _ in _walk(project_path, extensions, exclude_dirs):
+        try:
+            sources[os.path.relpath(entry.path, project_path)] = read_code(entry.path)
+        except Exception as e:
+            print(f"⚠️ Skipping {entry.name}: {e}")
+    return sources
+
+def explain_project(sources):
     """
+    Args:
+        sources (dict): {rel_path: code} as returned by collect_files
+
     Returns:
         summary_text (str): Overview of the project
         ai_suggestions (str): Improvement recommendations
     """
-    all_code = ""
-    for root, dirs, files in os.walk(project_path):
-        dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS]
-        for file in files:
-            ext = os.path.splitext(file)[1].lower()
-            if ext not in ALLOWED_EXTENSIONS:
-                continue
-            try:
-                all_code += read_code(os.path.join(root, file)) + "\n\n"
-            except Exception as e:
-                print(f"⚠️ Skipping {file}: {e}")
+    # Trim each file first and stop once the budget is reached, rather than
+    # concatenating the whole project only to slice it afterwards
+    parts, size = [], 0
+    for rel_path, code in sources.items():
+        if size >= PROJECT_CODE_CHARS:
+            break
+        if os.path.splitext(rel_path)[1].lower() not in ALLOWED_EXTENSIONS:
+            continue
+        part = truncate_code(code) + "\n\n"
+        parts.append(part)
+        size += len(part)
+    all_code = "".join(parts)
+
+    # Both prompts start with the same code block and differ only in the trailing
+    # task, so the provider can serve the shared prefix from its prompt cache
+    prefix = f"Here is the project's code:\n\n{all_code[:PROJECT_CODE_CHARS]}\n\n"  # limit so we don't overflow context
 
     # Call model for summary
-    summary_prompt = (
-        "Provide a short, plain-English overview of the following project's codebase:\n\n"
-        f"{all_code[:12000]}"  # limit so we don't overflow context
-    )
-    summary_text = call_llm(summary_prompt)
+    summary_text = call_llm(prefix + "Task: provide a short, plain-English overview of this project's codebase.")
 
     # Call model for improvement suggestions
-    suggestions_prompt = (
-        "Analyze the following project's codebase and suggest specific improvements in style, "
-        "performance, and maintainability:\n\n"
-        f"{all_code[:12000]}"
+    ai_suggestions = call_llm(
+        prefix + "Task: suggest specific improvements to this codebase in style, performance, and maintainability."
     )
-    ai_suggestions = call_llm(suggestions_prompt)
 
     return summary_text, ai_suggestions
 
@@ -1,7 +1,4 @@
 import pypandoc
-from pygments import highlight
-from pygments.lexers import PythonLexer, guess_lexer
-from pygments.formatters import HtmlFormatter
 import sys
 import os
 
@@ -15,21 +12,15 @@ def code_to_markdown(file_path):
 
 
 def markdown_to_pdf(md_content, output_path):
-    # Save markdown temp file
-    temp_md = "temp.md"
-    with open(temp_md, "w", encoding="utf-8") as f:
-        f.write(md_content)
-
-    # Convert to PDF using Pandoc + XeLaTeX
-    pypandoc.convert_file(
-        temp_md,
+    # Convert to PDF using Pandoc + XeLaTeX, piping the markdown in directly
+    pypandoc.convert_text(
+        md_content,
         'pdf',
+        format='md',
         outputfile=output_path,
         extra_args=['--pdf-engine=xelatex']
     )
 
-    os.remove(temp_md)
-
 if __name__ == "__main__":
     if len(sys.argv) < 2:
         print("Usage: python main.py <codefile>")
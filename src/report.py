@@ -1,51 +1,51 @@
 import os
-import re
 import sys
 import lizard
-from fpdf import FPDF
-from explainer import explain_project, ALLOWED_EXTENSIONS, EXCLUDE_DIRS
+from concurrent.futures import ProcessPoolExecutor
+from explainer import collect_files, explain_project, save_pdf_from_markdown, ALLOWED_EXTENSIONS, EXCLUDE_DIRS
 
 
-EXCLUDE_DIRS = {"node_modules", ".git", "__pycache__", "venv", ".idea", ".vscode"}
+EXCLUDE_DIRS = EXCLUDE_DIRS | {"venv", ".idea", ".vscode"}
+LIZARD_EXTENSIONS = (".js", ".py", ".java", ".cpp", ".c", ".ts")
 OUTPUT_DIR = os.path.join(os.path.dirname(__file__), "../output")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
 def remove_unicode(text):
-    return re.sub(r'[^\x00-\x7F]+', '', text)
+    return text.encode('ascii', errors='ignore').decode('ascii')
 
-class PDF(FPDF):
-    def chapter_title(self, title):
-        self.set_font('Arial', 'B', 14)
-        self.cell(0, 10, title, 0, 1, 'L')
-        self.ln(2)
-    def chapter_body(self, body):
-        self.set_font('Arial', '', 12)
-        self.multi_cell(0, 10, body)
-        self.ln()
+def _analyze_source(item):
+    """Run lizard on one (rel_path, code) pair in a worker process; returns its function list."""
+    rel_path, code = item
+    try:
+        return lizard.analyze_file.analyze_source_code(rel_path, code).function_list
+    except Exception as e:
+        print(f"⚠️ Error analyzing {rel_path}: {e}")
+        return []
 
-def run_lizard(path):
+def run_lizard(sources):
+    items = [(rel_path, code) for rel_path, code in sources.items()
+             if rel_path.endswith(LIZARD_EXTENSIONS)]
+
+    # lizard's tokenizer is pure Python, so spread files across processes
     results = []
-    for root, dirs, files in os.walk(path):
-        dirs[:] = [d for d in dirs if d not in EXCLUDE_DIRS]
-        for file in files:
-            if file.endswith((".js", ".py", ".java", ".cpp", ".c", ".ts")):
-                file_path = os.path.join(root, file)
-                try:
-                    results.extend(lizard.analyze_file(file_path).function_list)
-                except Exception as e:
-                    print(f"⚠️ Error analyzing {file_path}: {e}")
+    with ProcessPoolExecutor() as executor:
+        for functions in executor.map(_analyze_source, items, chunksize=8):
+            results.extend(functions)
     return results
 
 
 
 def generate_report(project_path):
+    # One walk + read feeds both the AI analysis and lizard
+    sources = collect_files(project_path, ALLOWED_EXTENSIONS | set(LIZARD_EXTENSIONS), EXCLUDE_DIRS)
+
     print("📊 Running AI analysis...")
-    summary_text, ai_suggestions = explain_project(project_path)
+    summary_text, ai_suggestions = explain_project(sources)
     summary_text = remove_unicode(summary_text)
     ai_suggestions = remove_unicode(ai_suggestions)
 
     print("📈 Running complexity analysis...")
-    functions = run_lizard(project_path)
+    functions = run_lizard(sources)
     complexity_report = "\n".join(
         [f"{func.name} - CC: {func.cyclomatic_complexity} - LOC: {func.length}"
          for func in functions]
@@ -53,17 +53,15 @@ def generate_report(project_path):
     complexity_report = remove_unicode(complexity_report)
 
     print("📝 Generating PDF report...")
-    pdf = PDF()
-    pdf.add_page()
-    pdf.chapter_title("Project Summary")
-    pdf.chapter_body(summary_text)
-    pdf.chapter_title("AI Recommendations")
-    pdf.chapter_body(ai_suggestions)
-    pdf.chapter_title("Complexity Report")
-    pdf.chapter_body(complexity_report)
-
+    report_md = (
+        f"# Project Summary\n\n{summary_text}\n\n"
+        f"# AI Recommendations\n\n{ai_suggestions}\n\n"
+        f"# Complexity Report\n\n```\n{complexity_report}\n```\n"
+    )
     output_path = os.path.join(OUTPUT_DIR, "project_report.pdf")
-    pdf.output(output_path)
+    # The sections are free-form LLM prose: stray backslashes or $...$ pairs must
+    # stay literal text rather than become raw LaTeX or math that breaks xelatex
+    save_pdf_from_markdown(report_md, output_path, from_format="markdown-raw_tex-tex_math_dollars")
     print(f"✅ Report generated: {output_path}")
 
 if __name__ == "__main__":